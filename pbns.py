@@ -4,18 +4,27 @@ A notification handler for Pushbullet that sends pushes via dbus.
 """
 
 import argparse
+import collections
+import errno
 import functools
 import json
 import logging
 import os
+import pathlib
+import queue
+import select
 import socket
 import sys
 import time
 import textwrap
+import threading
 
-import dbus
-import pushbullet
-import requests.exceptions
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+log = logging.getLogger(__name__)
 
 HTTP_PROXY_HOST = None
 HTTP_PROXY_PORT = None
@@ -23,8 +32,108 @@ HTTP_PROXY_PORT = None
 CONFIG_BASEDIR = os.path.join(os.path.expanduser("~"), ".config", "pbns")
 API_KEY_PATH = os.path.join(CONFIG_BASEDIR, "apikey")
 PASSWORD_PATH = os.path.join(CONFIG_BASEDIR, "password")
+CONFIG_FILE_MAX_SIZE = 4096
+
+CACHE_BASEDIR = os.path.join(os.path.expanduser("~"), ".cache", "pbns")
+CURSOR_PATH = os.path.join(CACHE_BASEDIR, "cursor")
+
+ICON = str(pathlib.Path(__file__).resolve().parent / "pbns_logo.png")
+
+PUSHBULLET_HOST = "api.pushbullet.com"
+PUSHBULLET_PORT = 80
+CONNECT_TIMEOUT = 2.0
+ADDRINFO_TTL = 60
+MAX_RETRY_DELAY = 10
+MAX_RECONNECT_DELAY = 60
+STABLE_CONNECTION_TIME = 60
+
+# (expiry time, getaddrinfo() result)
+_ADDRINFO_CACHE = (0, None)
+
+# Socket address of the last successful connection probe
+_LAST_GOOD_ADDRESS = None
+
+DBUS_NAME = DBUS_INTERFACE = "org.freedesktop.Notifications"
+DBUS_PATH = "/org/freedesktop/Notifications"
+
+# D-Bus `Notifications` interface, owned by the notifier thread
+_NOTIFICATIONS = None
+
+# Pending (title, body) pairs, drained by the notifier thread
+_NOTIFY_QUEUE = queue.Queue()
+_NOTIFIER_THREAD = None
+
+# Mirrored pushes waiting to be sent, as (title, body, summary line) tuples
+# keyed by application name
+MIRROR_BATCH_WINDOW = 0.25
+MIRROR_BATCH_MAX_HOLD = 4 * MIRROR_BATCH_WINDOW
+_PENDING_MIRRORS = collections.defaultdict(list)
+_PENDING_LOCK = threading.Lock()
+_FLUSH_TIMER = None
+# time.monotonic() of the first and the latest pending mirror
+_FIRST_MIRROR_TIME = 0
+_LAST_MIRROR_TIME = 0
 
-ICON = os.path.join(os.path.abspath(sys.path[0]), "pbns_logo.png")
+# `modified` timestamp of the latest push fetched on a tickle, saved to
+# CURSOR_PATH whenever it advances
+_PUSH_CURSOR = None
+
+
+def resolve_pushbullet():
+    """
+    Return the address list for the Pushbullet API host, reusing the
+    previous lookup for `ADDRINFO_TTL` seconds.
+    """
+
+    global _ADDRINFO_CACHE
+
+    expiry, addrinfo = _ADDRINFO_CACHE
+    if addrinfo is None or time.monotonic() >= expiry:
+        addrinfo = socket.getaddrinfo(PUSHBULLET_HOST, PUSHBULLET_PORT,
+                                      type=socket.SOCK_STREAM)
+        _ADDRINFO_CACHE = (time.monotonic() + ADDRINFO_TTL, addrinfo)
+
+    return addrinfo
+
+
+def try_connect(addrinfo):
+    """
+    Return True if a TCP connection can be established to any of the
+    addresses in `addrinfo` within `CONNECT_TIMEOUT` seconds. The address
+    that worked last time is tried first.
+    """
+
+    global _LAST_GOOD_ADDRESS
+
+    addrinfo = sorted(addrinfo, key=lambda info: info[4] != _LAST_GOOD_ADDRESS)
+
+    for family, sock_type, proto, _, address in addrinfo:
+        try:
+            sock = socket.socket(family, sock_type, proto)
+        except OSError as exception:
+            log.debug("Can't create socket for %s: %s", address, exception)
+            continue
+
+        with sock:
+            try:
+                sock.setblocking(False)
+                err = sock.connect_ex(address)
+            except OSError as exception:
+                log.debug("Can't connect to %s: %s", address, exception)
+                continue
+
+            if err not in (0, errno.EINPROGRESS):
+                continue
+
+            _, writable, _ = select.select([], [sock], [], CONNECT_TIMEOUT)
+            if not writable:
+                continue
+
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                _LAST_GOOD_ADDRESS = address
+                return True
+
+    return False
 
 
 def wait_for_internet():
@@ -33,17 +142,46 @@ def wait_for_internet():
     available.
     """
 
+    attempt = 0
     while True:
         try:
-            logging.debug("Trying connection to Pushbullet API.")
-            socket.create_connection(('api.pushbullet.com', '80'), timeout=30)
-            logging.debug("Connection successful.")
-            break
+            log.debug("Trying connection to Pushbullet API.")
+            if try_connect(resolve_pushbullet()):
+                log.debug("Connection successful.")
+                break
 
-        except (socket.gaierror, socket.timeout,
-                ConnectionRefusedError, requests.exceptions.ConnectionError):
-            logging.debug("Connection failed. Retrying in 10 seconds")
-            time.sleep(10)
+        except OSError as exception:
+            log.debug("Connection failed: %s", exception)
+
+        delay = min(MAX_RETRY_DELAY, 0.5 * 2 ** attempt)
+        attempt += 1
+        log.debug("Connection failed. Retrying in %.1f seconds", delay)
+        time.sleep(delay)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_config_file(path, mtime_ns):
+    """
+    Return the stripped contents of the config file at `path`. Results are
+    cached per (path, mtime) so the file is only read again if it changes.
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        data = os.read(fd, CONFIG_FILE_MAX_SIZE)
+    finally:
+        os.close(fd)
+
+    return data.decode().strip()
+
+
+def read_config_file(path):
+    """
+    Return the stripped contents of the config file at `path`, reusing the
+    cached value if the file hasn't been modified since the last read.
+    """
+
+    return _read_config_file(path, os.stat(path).st_mtime_ns)
 
 
 def get_encryption_password(passwd_path):
@@ -52,17 +190,13 @@ def get_encryption_password(passwd_path):
     """
 
     try:
-        with open(passwd_path) as passwd_file:
-            password = passwd_file.read()
-            password = password.strip()
-
-        return password
+        return read_config_file(passwd_path)
 
     except FileNotFoundError:
         no_crypto_warn = ("Can't use encryption due to inexistent password. "
                           "If you wish to use encryption, place your "
                           "encryption password into %s")
-        logging.warning(no_crypto_warn, passwd_path)
+        log.warning(no_crypto_warn, passwd_path)
 
 
 def get_api_key(api_key_path):
@@ -71,11 +205,7 @@ def get_api_key(api_key_path):
     """
 
     try:
-        with open(api_key_path) as api_key:
-            api_key = api_key.read()
-            api_key = api_key.strip()
-
-        return api_key
+        return read_config_file(api_key_path)
 
     except FileNotFoundError:
         err_msg = ("Couldn't load your access token. Create one at "
@@ -83,31 +213,129 @@ def get_api_key(api_key_path):
                    "and paste it into '{}'.")
 
         err_msg = err_msg.format(API_KEY_PATH)
-        logging.error(err_msg)
+        log.error(err_msg)
         sys.exit(1)
 
 
-def notify(title, body):
+def _load_dbus():
+    """
+    Import and return dbus-python. main() calls this before connecting, so
+    a missing or broken install fails at startup rather than in the
+    notifier thread.
+    """
+
+    import dbus
+
+    return dbus
+
+
+def _get_notifications():
+    """
+    Return the D-Bus interface for `org.freedesktop.Notifications`,
+    connecting to the session bus the first time it is needed.
+    """
+
+    global _NOTIFICATIONS
+
+    if _NOTIFICATIONS is None:
+        import dbus
+
+        bus = dbus.SessionBus()
+        proxy = bus.get_object(DBUS_NAME, DBUS_PATH)
+        _NOTIFICATIONS = dbus.Interface(proxy, DBUS_INTERFACE)
+
+    return _NOTIFICATIONS
+
+
+def send_notification(title, body):
     """
-    Open a D-Bus object for the `Notifications` interface and send the
-    notification through it.
+    Send the notification through the D-Bus `Notifications` interface. If
+    the cached interface has gone stale, reconnect and retry once.
     """
 
-    logging.debug("Sending notification via D-Bus")
+    global _NOTIFICATIONS
+
+    import dbus
+
+    log.debug("Sending notification via D-Bus")
+
+    body = "\n".join(textwrap.fill(line) for line in body.splitlines())
 
-    interface = "org.freedesktop.Notifications"
-    item = "org.freedesktop.Notifications"
-    path = "/org/freedesktop/Notifications"
+    args = ("Pushbullet", 0, ICON, title, body, "", "", 10000)
 
-    bus = dbus.SessionBus()
-    proxy = bus.get_object(item, path)
-    notifications = dbus.Interface(proxy, interface)
+    try:
+        _get_notifications().Notify(*args)
 
-    title = title.strip()
-    body = body.strip()
-    body = textwrap.fill(body)
+    except dbus.exceptions.DBusException:
+        log.debug("D-Bus call failed. Reconnecting to the session bus.")
+        _NOTIFICATIONS = None
+        _get_notifications().Notify(*args)
 
-    notifications.Notify("Pushbullet", 0, ICON, title, body, "", "", 10000)
+
+def _notifier():
+    """
+    Send queued notifications one by one, so that callers never wait for
+    the notification daemon to reply.
+    """
+
+    while True:
+        title, body = _NOTIFY_QUEUE.get()
+
+        try:
+            send_notification(title, body)
+
+        except Exception:
+            log.exception("Notification failed")
+
+        finally:
+            _NOTIFY_QUEUE.task_done()
+
+
+def load_push_cursor(cursor_path):
+    """
+    Return the push cursor saved by a previous run, or None
+    """
+
+    try:
+        with open(cursor_path) as cursor_file:
+            return float(cursor_file.read())
+
+    except (OSError, ValueError):
+        return None
+
+
+def save_push_cursor(cursor_path):
+    """
+    Save the push cursor so that a restart doesn't notify old pushes again
+    """
+
+    if _PUSH_CURSOR is None:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(cursor_path), exist_ok=True)
+        with open(cursor_path, "w") as cursor_file:
+            cursor_file.write(repr(_PUSH_CURSOR))
+
+    except OSError as exception:
+        log.warning("Couldn't save push cursor: %s", exception)
+
+
+def notify(title, body):
+    """
+    Queue a notification to be sent via D-Bus by the notifier thread,
+    starting the thread on first use.
+    """
+
+    global _NOTIFIER_THREAD
+
+    if _NOTIFIER_THREAD is None:
+        _NOTIFIER_THREAD = threading.Thread(target=_notifier,
+                                            name="pbns-notifier",
+                                            daemon=True)
+        _NOTIFIER_THREAD.start()
+
+    _NOTIFY_QUEUE.put((title, body))
 
 
 def handle_mirror(push):
@@ -117,10 +345,83 @@ def handle_mirror(push):
         2. push body
     """
 
-    title = "[{}] {}"
-    title = title.format(push["application_name"], push["title"])
+    title = (push.get("title") or "").strip()
+    body = (push.get("body") or "").strip()
+
+    return f"[{push['application_name']}] {title}", body
+
+
+def _schedule_flush(delay):
+    """
+    Start the timer that calls `flush_mirrors` after `delay` seconds. Must
+    be called with `_PENDING_LOCK` held.
+    """
+
+    global _FLUSH_TIMER
+
+    _FLUSH_TIMER = threading.Timer(delay, flush_mirrors)
+    _FLUSH_TIMER.daemon = True
+    _FLUSH_TIMER.start()
+
+
+def flush_mirrors():
+    """
+    Send the mirrored pushes collected by `queue_mirror`, one notification
+    per application. If mirrors are still arriving, wait until they stop
+    for `MIRROR_BATCH_WINDOW` seconds, but never hold the first one for
+    more than `MIRROR_BATCH_MAX_HOLD` seconds.
+    """
+
+    global _PENDING_MIRRORS, _FLUSH_TIMER
+
+    with _PENDING_LOCK:
+        now = time.monotonic()
+        flush_at = min(_LAST_MIRROR_TIME + MIRROR_BATCH_WINDOW,
+                       _FIRST_MIRROR_TIME + MIRROR_BATCH_MAX_HOLD)
+        if now < flush_at:
+            _schedule_flush(flush_at - now)
+            return
+
+        _FLUSH_TIMER = None
+        pending, _PENDING_MIRRORS = (_PENDING_MIRRORS,
+                                     collections.defaultdict(list))
+
+    for app, mirrors in pending.items():
+        if len(mirrors) == 1:
+            title, body, _ = mirrors[0]
+            notify(title, body)
+            continue
+
+        title = f"[{app}] {len(mirrors)} messages"
+        body = "\n".join(summary for _, _, summary in mirrors)
+        notify(title, body)
+
+
+def queue_mirror(push):
+    """
+    Hold a mirrored push briefly so that bursts from the same application
+    are sent as a single notification. See `flush_mirrors`.
+
+    The push is formatted here, on the listener thread, so that a malformed
+    push is reported by the listener instead of breaking a whole batch.
+    """
+
+    global _FIRST_MIRROR_TIME, _LAST_MIRROR_TIME
+
+    title, body = handle_mirror(push)
+    if not body:
+        return
 
-    return title, push["body"]
+    summary = "{}: {}".format((push.get("title") or "").strip(), body)
+
+    with _PENDING_LOCK:
+        _PENDING_MIRRORS[push["application_name"]].append((title, body,
+                                                           summary))
+        _LAST_MIRROR_TIME = time.monotonic()
+
+        if _FLUSH_TIMER is None:
+            _FIRST_MIRROR_TIME = _LAST_MIRROR_TIME
+            _schedule_flush(MIRROR_BATCH_WINDOW)
 
 
 def handle_push(push):
@@ -128,20 +429,14 @@ def handle_push(push):
     Returns two strings: the title and the body
     """
 
-    if "title" not in push.keys():
-        if "sender_name" in push.keys():
-            title = push["sender_name"]
-        else:
-            title = ""
-    else:
-        title = push["title"]
+    title = push.get("title") or push.get("sender_name", "")
 
     if "body" not in push and push["type"] == "file":
         body = "New file received: {}".format(push["file_name"])
     else:
         body = push["body"]
 
-    return title, body
+    return title.strip(), body.strip()
 
 
 def check_if_dismissed(push):
@@ -149,41 +444,77 @@ def check_if_dismissed(push):
     Returns True if `push` is dismissed
     """
 
-    return "dismissed" in push.keys() and push["dismissed"]
+    return bool(push.get("dismissed"))
 
 
-def on_push(account, push):
+def _handle_tickle(push, account):
     """
-    Handle last push
+    Fetch the latest push modified since the previous tickle and notify it
     """
 
-    title, body = None, None
+    global _PUSH_CURSOR
 
-    logging.debug("Got push: %s", push)
+    pushes = account.get_pushes(modified_after=_PUSH_CURSOR, limit=1)
+    if not pushes:
+        log.debug("No pushes modified since %s", _PUSH_CURSOR)
+        return
 
-    if push["type"] == "tickle":
-        # Overwrite push with latest push
-        push = account.get_pushes()[0]
+    push = pushes[0]
+    if push.get("modified", 0) <= (_PUSH_CURSOR or 0):
+        log.debug("Push already handled")
+        return
 
-        logging.debug("Last push: %s", push)
-        title, body = handle_push(push)
+    _PUSH_CURSOR = push["modified"]
+    save_push_cursor(CURSOR_PATH)
 
-    elif push["type"] == "push":
-        push = push["push"]
-
-        logging.debug("Push contents: %s", push)
-        if push["encrypted"]:
-            decrypted = account._decrypt_data(push["ciphertext"])
-            push = json.loads(decrypted)
-            logging.debug("Decrypted contents: %s", push)
-
-        if push["type"] == "mirror":
-            title, body = handle_mirror(push)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Last push: %s", push)
 
+    title, body = handle_push(push)
     if title and body and not check_if_dismissed(push):
         notify(title, body)
 
 
+def _handle_wrapped_push(push, account):
+    """
+    Unwrap (and decrypt, if needed) an ephemeral push and queue it if it's
+    a mirrored notification
+    """
+
+    push = push["push"]
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Push contents: %s", push)
+    if push["encrypted"]:
+        decrypted = account._decrypt_data(push["ciphertext"])
+        push = json_loads(decrypted)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Decrypted contents: %s", push)
+
+    if push["type"] == "mirror" and not check_if_dismissed(push):
+        queue_mirror(push)
+
+
+# Handlers for the `type` field of incoming stream messages
+_HANDLERS = {
+    "tickle": _handle_tickle,
+    "push": _handle_wrapped_push,
+}
+
+
+def on_push(account, push):
+    """
+    Handle last push
+    """
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Got push: %s", push)
+
+    handler = _HANDLERS.get(push["type"])
+    if handler is not None:
+        handler(push, account)
+
+
 def on_error(_, exception):
     """
     Handle errors during listener.run_forever().
@@ -198,10 +529,15 @@ def connect(api_key, password):
     etc. We'll pass it to the `on_push` handler afterwards.
     """
 
+    import pushbullet
+
     pb_account = pushbullet.Pushbullet(api_key, encryption_password=password)
 
+    def on_account_push(push):
+        on_push(pb_account, push)
+
     listener = pushbullet.Listener(account=pb_account,
-                                   on_push=functools.partial(on_push, pb_account),
+                                   on_push=on_account_push,
                                    on_error=on_error,
                                    http_proxy_host=HTTP_PROXY_HOST,
                                    http_proxy_port=HTTP_PROXY_PORT)
@@ -214,36 +550,57 @@ def main():
     Initialize app and listen for new pushes
     """
 
+    global _PUSH_CURSOR
+
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--debug", help="Output debugging information",
                         action="store_true")
     args = parser.parse_args()
-    if args.debug:
-        log_format = ("%(asctime)s [%(levelname)5s]"
-                      " [%(filename)s:%(lineno)s] %(message)s")
-        logging.basicConfig(level=logging.DEBUG,
-                            format=log_format)
+
+    log_format = ("%(asctime)s [%(levelname)5s]"
+                  " [%(filename)s:%(lineno)s] %(message)s")
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format=log_format)
 
     api_key = get_api_key(API_KEY_PATH)
     password = get_encryption_password(PASSWORD_PATH)
 
+    _PUSH_CURSOR = load_push_cursor(CURSOR_PATH)
+
+    _load_dbus()
+
+    listener = None
+    backoff = 1.0
+
     try:
         while True:
             wait_for_internet()
 
             listener = connect(api_key, password)
             notify("PBNS started", "PBNS is now listening for new pushes.")
+
+            started = time.monotonic()
             listener.run_forever()
 
             # We get here after the listener closes after an interrupted
             # socket connection
+            listener.close()
             notify("PBNS connection lost",
                    ("PBNS has lost its connection with Pushbullet servers "
                     "and will notify you when the connection is regained."))
 
+            # Back off if the connection keeps dropping right away
+            if time.monotonic() - started > STABLE_CONNECTION_TIME:
+                backoff = 1.0
+            else:
+                log.debug("Reconnecting in %.1f seconds", backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_RECONNECT_DELAY)
+
     except KeyboardInterrupt:
-        logging.debug("Keyboard interrupt. Cleaning up.")
-        listener.close()
+        log.debug("Keyboard interrupt. Cleaning up.")
+        if listener is not None:
+            listener.close()
         sys.exit()
 
 